@@ -29,13 +29,29 @@
 import yaml
 import subprocess
 import os
-import pathlib
 import shutil
 import sys
 import logging
 import threading
+import concurrent.futures
+import queue
+import itertools
+import operator
 import re
+import shlex
+import signal
 import time
+import copy
+import pickle
+
+# use the libyaml backed loader when available, callers should use
+# yaml.load(stream, Loader=SafeLoader) instead of yaml.safe_load.
+try:
+  from yaml import CSafeLoader as SafeLoader
+  _LIBYAML = True
+except ImportError:
+  from yaml import SafeLoader
+  _LIBYAML = False
 
 try:
   import progressbar
@@ -45,31 +61,168 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# matches {option} placeholders in command templates
+_OPT_RE = re.compile(r'\{(.*?)\}')
+
+# number of projects above which _process parses projects in a process pool
+_PROCESS_POOL_MIN_PROJECTS = 50
+
+_YAML_CACHE_FILE = ".builder_yaml_cache.pkl"
+
+_libyaml_warned = False
+
+# parsed yaml files keyed by (abs_path, st_mtime_ns, st_size), persisted to _YAML_CACHE_FILE
+_YAML_CACHE = None
+
+# load the pickled yaml cache from a previous run, if any
+def _yaml_cache_load():
+  global _YAML_CACHE
+
+  if _YAML_CACHE is not None:
+    return _YAML_CACHE
+
+  _YAML_CACHE = {}
+
+  try:
+    with open(_YAML_CACHE_FILE, 'rb') as stream:
+      loaded = pickle.load(stream)
+    if isinstance(loaded, dict):
+      _YAML_CACHE = loaded
+  except FileNotFoundError:
+    pass
+  except Exception as e:
+    logger.debug(f"Ignoring unreadable yaml cache {_YAML_CACHE_FILE}: {str(e)}")
+
+  return _YAML_CACHE
+
+# write the yaml cache out for the next run, failure only costs a reparse
+def _yaml_cache_save():
+  try:
+    with open(_YAML_CACHE_FILE, 'wb') as stream:
+      pickle.dump(_YAML_CACHE, stream, protocol=pickle.HIGHEST_PROTOCOL)
+  except Exception as e:
+    logger.debug(f"Unable to write yaml cache {_YAML_CACHE_FILE}: {str(e)}")
+
+# parse a yaml file, reusing the last parse if the file has not changed.
+# returns a deep copy so callers are free to mutate the data.
+def load_yaml_cached(path):
+  global _libyaml_warned
+
+  abs_path = os.path.abspath(path)
+
+  stat = os.stat(abs_path)
+
+  key = (abs_path, stat.st_mtime_ns, stat.st_size)
+
+  cache = _yaml_cache_load()
+
+  if key in cache:
+    return copy.deepcopy(cache[key])
+
+  if not _LIBYAML and not _libyaml_warned:
+    _libyaml_warned = True
+    logger.warning("libyaml not available, using pure python yaml loader. Install libyaml-dev and reinstall pyyaml.")
+
+  with open(abs_path, 'r') as stream:
+    loaded = yaml.load(stream, Loader=SafeLoader)
+
+  #drop stale parses of the same file
+  for stale in [k for k in cache if k[0] == abs_path]:
+    del cache[stale]
+
+  cache[key] = loaded
+
+  _yaml_cache_save()
+
+  return copy.deepcopy(loaded)
+
+# escape a path for use in a ninja build statement
+def _ninja_escape(path):
+  return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+# create the run type dict of command lists for a single project, this is kept free of
+# bob state so _process can hand it to a process pool.
+def _process_one(project, parts, tpl_tokens, pwd):
+  project_run_type = {}
+
+  project_items = 0
+
+  for run_type, part in parts.items():
+    if not part:
+      continue
+
+    project_parts = []
+
+    for part, command in part.items():
+      try:
+        part_template = tpl_tokens[part]
+      except KeyError:
+        raise Exception(f"No build rule for part: {part}.")
+
+      #auto filled values are quoted so paths with spaces or quotes stay whole after the split below
+      command = dict(command, _pwd=shlex.quote(pwd), _project_name=shlex.quote(str(project)))
+
+      part_commands = []
+
+      for commands in part_template:
+        #format each token on its own, then split it shell style so build.yml values like args can
+        #expand to several arguments while quoted values with spaces stay a single argument.
+        try:
+          list_command = [arg for token in commands for arg in shlex.split(token.format_map(command))]
+        except ValueError as e:
+          raise Exception(f"Bad quoting in part {part} of project {project}: {e}")
+
+        part_commands.append(list_command)
+
+        project_items = project_items + 1
+
+      project_parts.append(part_commands)
+
+    project_run_type[run_type] = project_parts
+
+  return project, project_run_type, project_items
+
 class bob:
   def __init__(self, yaml_build_cmds_file, yaml_data, target = None, dryrun = False):
     self._yaml_data = yaml_data
     self._yaml_build_cmds_file = yaml_build_cmds_file
     self._target = target
     self._dryrun = dryrun
+    self._pwd = os.getcwd()
+    self._env = os.environ.copy()
     self._command_template = None
+    self._tpl_tokens = None
     self._projects = None
-    self._threads  = []
-    self._processes = []
+    self._project_items = None
+    self._plan = None
+    self._live_procs = set()
     self._failed = False
-    self._thread_lock = None
+    #guards _live_procs only, shared by the builder threads and stop()
+    self._thread_lock = threading.RLock()
     self._items = 0
     self._items_done = 0
+    self._done_q = queue.SimpleQueue()
     self._project_name = "None"
 
   def stop(self):
     self._failed = True
 
     if self._dryrun is False:
-      for p in self._processes:
-        p.terminate()
+      with self._thread_lock:
+        live_procs = list(self._live_procs)
+
+      for p in live_procs:
+        self._signal_process(p)
 
     logger.info(f"Thread terminate sent to stop builders.")
 
+  # each command runs in its own session, signal the whole group so tools spawned by it stop too
+  def _signal_process(self, process):
+    try:
+      os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+      pass
+
   # run the steps to build parts of targets
   def run(self):
     try:
@@ -101,30 +254,90 @@ class bob:
 
       str_options = str_options.replace('{_pwd}', '')
 
-      str_options = re.findall(r'\{(.*?)\}', str_options)
-
-      filter_options = list(set(str_options))
+      filter_options = sorted(set(_OPT_RE.findall(str_options)))
 
       print(f"COMMAND: {tool:<16} OPTIONS: {filter_options}")
 
-  def _gen_build_cmds(self):
+  # write the commands as a ninja build file instead of running them. Edges keep the same
+  # ordering as run(), concurrent parts are independent chains and everything else is serial.
+  def ninja(self, file_name):
     try:
-      stream = open(self._yaml_build_cmds_file, 'r')
+      self._gen_build_cmds()
     except Exception as e: raise
 
-    loaded = None
+    try:
+      self._process()
+    except Exception as e: raise
+
+    lines = []
+
+    lines.append("# generated by system_builder.py, run from the repository root with: ninja -f " + _ninja_escape(file_name))
+    lines.append("")
+    lines.append("rule cmd")
+    lines.append("  command = $cmd")
+    lines.append("  description = $cmd")
+    lines.append("")
+
+    barrier = None
+
+    for project, run_types in self._projects.items():
+      for run_type, commands in run_types.items():
+        if run_type not in ('concurrent', 'sequential'):
+          raise Exception(f"RUN_TYPE {run_type} is not a valid selection")
+
+        tails = []
+
+        prev = barrier
+
+        for part_index, command_list in enumerate(commands):
+          #concurrent parts all start from the last barrier, sequential parts follow each other
+          if run_type == 'concurrent':
+            prev = barrier
+
+          for cmd_index, command in enumerate(command_list):
+            edge = _ninja_escape(f"{project}.{run_type}.{part_index}.{cmd_index}")
+
+            deps = f" | {prev}" if prev is not None else ""
+
+            lines.append(f"build {edge}: cmd{deps}")
+            lines.append(f"  cmd = {shlex.join(command).replace('$', '$$')}")
+
+            prev = edge
+
+          tails.append(prev)
+
+        if len(tails):
+          barrier = _ninja_escape(f"{project}.{run_type}")
+
+          lines.append(f"build {barrier}: phony {' '.join(tails)}")
+
+        lines.append("")
+
+      if barrier is not None:
+        lines.append(f"build {_ninja_escape(str(project))}: phony {barrier}")
+        lines.append("")
+
+    if barrier is not None:
+      lines.append(f"default {barrier}")
 
     try:
-      loaded = yaml.safe_load(stream)
-    except Exception as e:
-      stream.close()
-      raise
+      with open(file_name, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+    except Exception as e: raise
 
-    self._command_template = loaded
+    logger.info(f"Wrote ninja build file: {file_name}")
 
-    logger.debug(self._command_template)
+    return 0
 
-    stream.close()
+  def _gen_build_cmds(self):
+    try:
+      self._command_template = load_yaml_cached(self._yaml_build_cmds_file)
+    except Exception as e: raise
+
+    #templates are static, keep the argv token lists per tool so _process only has to format them.
+    self._tpl_tokens = {tool: [list(tokens) for tokens in commands.values()] for tool, commands in self._command_template.items()}
+
+    logger.debug(self._command_template)
 
   # create dict of dicts that contains lists with lists of lists to execute with subprocess
   # {'project': { 'concurrent': [[["make", "def_config"], ["make"]], [["fusesoc", "run", "--build", "--target", "zed_blinky", "::blinky:1.0.0"]]], 'sequential': [[]]}}
@@ -142,158 +355,197 @@ class bob:
 
     self._projects = {}
 
-    for project, parts in self._yaml_data.items():
-      project_run_type = {}
-
-      for run_type, part in parts.items():
-        project_parts = []
+    self._project_items = {}
 
-        for part, command in part.items():
-          try:
-            command_template = self._command_template[part].values()
-          except KeyError:
-            raise Exception(f"No build rule for part: {part}.")
+    projects = []
 
-          command.update({'_pwd' : os.getcwd()})
+    parts = []
 
-          command.update({'_project_name' : project})
+    for project, project_parts in self._yaml_data.items():
+      #targets without any parts have nothing to build
+      if not project_parts:
+        logger.info(f"No parts for project: {project}, skipping.")
+        continue
 
-          part_commands = []
+      projects.append(project)
 
-          for commands in command_template:
-            populate_command = []
+      parts.append(project_parts)
 
-            string_command = ' '.join(commands)
+    args = [projects, parts, itertools.repeat(self._tpl_tokens), itertools.repeat(self._pwd)]
 
-            list_command = list(string_command.format_map(command).split(" "))
-
-            part_commands.append(list_command)
+    #only worth the process startup cost when there are many projects to parse
+    if len(projects) > _PROCESS_POOL_MIN_PROJECTS:
+      with concurrent.futures.ProcessPoolExecutor() as exe:
+        results = list(exe.map(_process_one, *args))
+    else:
+      results = list(map(_process_one, *args))
 
-            logger.debug(part_commands)
+    for project, project_run_type, project_items in results:
+      self._projects[project] = project_run_type
 
-          project_parts.append(part_commands)
+      self._project_items[project] = project_items
 
-        project_run_type[run_type] = project_parts
-
-      self._projects[project] = project_run_type
+      logger.debug(project_run_type)
 
       logger.info(f"Added commands for project: {project}")
 
-  #call subprocess as a thread and add it to a list of threads for wait to check on.
+    #flatten to one ordered list of (project, run_type, command lists) for _execute to scan
+    self._plan = [(project, run_type, commands) for project, run_types in self._projects.items() for run_type, commands in run_types.items()]
+
+  #submit subprocess calls to a thread pool and wait on their futures.
   #iterate over projects avaiable and execute commands per project
   def _execute(self):
-    if self._projects == None:
+    if self._plan == None:
       raise Exception("NO PROJECTS AVAILABLE FOR BUILDER")
 
-    threading.excepthook = self._thread_exception
+    exe = concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4)*2))
+
+    try:
+      for project, steps in itertools.groupby(self._plan, key=operator.itemgetter(0)):
+        logger.info(f"Starting build for project: {project}")
 
-    self._thread_lock = threading.Lock()
+        self._items = self._project_items[project]
 
-    for project, run_types in self._projects.items():
-      logger.info(f"Starting build for project: {project}")
+        self._items_done = 0
 
-      self._items = self._project_cmd_count(run_types)
+        self._done_q = queue.SimpleQueue()
 
-      self._items_done = 0
+        #interned so the bar thread can detect a new name with an identity check
+        self._project_name = sys.intern(str(project))
 
-      self._threads.clear()
+        bar_thread = threading.Thread(target=self._bar_thread, name="bar")
 
-      self._project_name = project
+        bar_thread.start()
 
-      bar_thread = threading.Thread(target=self._bar_thread, name="bar")
+        for _, run_type, commands in steps:
+          if run_type == 'concurrent':
+            futs = []
 
-      bar_thread.start()
+            for command_list in commands:
+              logger.debug("CONCURRENT: " + str(command_list))
 
-      for run_type, commands in run_types.items():
-        if run_type == 'concurrent':
-          for command_list in commands:
-            logger.debug("CONCURRENT: " + str(command_list))
-            thread = threading.Thread(target=self._subprocess, name=project, args=[command_list])
+              futs.append(exe.submit(self._subprocess, command_list))
 
-            self._threads.append(thread)
+            done, pending = concurrent.futures.wait(futs, return_when=concurrent.futures.FIRST_EXCEPTION)
 
-            thread.start()
+            for fut in done:
+              if fut.exception() is not None:
+                self.stop()
 
-            time.sleep(2)
+                for f in pending:
+                  f.cancel()
 
-          for t in self._threads:
-            t.join()
+                logger.error(f"Build failed, terminated subprocess and program. {str(fut.exception())}")
 
-          if self._failed:
-            raise Exception(f"One or more threads failed.")
+                raise Exception(f"One or more threads failed.")
 
-        elif run_type == 'sequential':
-          for command_list in commands:
-            logger.debug("SEQUENTIAL: " + str(command_list))
+          elif run_type == 'sequential':
+            for command_list in commands:
+              logger.debug("SEQUENTIAL: " + str(command_list))
 
-            try:
-              self._subprocess(command_list)
-            except Exception as e:
-              self._failed = True
-              time.sleep(2)
-              raise
+              try:
+                self._subprocess(command_list)
+              except Exception as e:
+                self._failed = True
+                time.sleep(2)
+                raise
 
-        else:
-          raise Exception(f"RUN_TYPE {run_type} is not a valid selection")
+          else:
+            raise Exception(f"RUN_TYPE {run_type} is not a valid selection")
 
-      bar_thread.join()
+        bar_thread.join()
+    except BaseException:
+      #commands don't get the terminal's SIGINT in their own session, signal them before the pool shuts down
+      if self._failed is False:
+        self.stop()
+      raise
+    finally:
+      #on failure don't wait on commands that were just signaled, or queued ones
+      exe.shutdown(wait=not self._failed, cancel_futures=True)
 
   def _subprocess(self, list_of_commands):
     for command in list_of_commands:
       process = None
-      cmd_output = None
-      cmd_error = None
+      cmd_error = []
+      cmd_str = shlex.join(command)
 
       if self._failed:
-        raise Exception(f"Previous build process failed, aborting: {' '.join(command)}")
+        raise Exception(f"Previous build process failed, aborting: {cmd_str}")
 
-      logger.info(f"Executing command: {' '.join(command)}")
+      if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Executing command: {cmd_str}")
 
       if self._dryrun is False:
         try:
-          process = subprocess.Popen(command, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=str(pathlib.Path.cwd()))
-          self._processes.append(process)
-          cmd_output, cmd_error = process.communicate()
-          exception = process.poll()
-          if exception:
-            if cmd_error:
-              for line in cmd_error.split('\n'):
-                if len(line):
-                  logger.error(line)
-            raise Exception(f"Issue executing command: {' '.join(command)}")
-        except Exception as e: raise
+          process = subprocess.Popen(command, text=True, bufsize=1, errors='replace', stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self._pwd, env=self._env, start_new_session=True)
 
-        if cmd_output:
-          for line in cmd_output.split('\n'):
-            logger.debug(line)
+          #stop() sets _failed before it takes its snapshot, so a command started after the
+          #snapshot sees it here and is signaled instead of outliving the builder
+          with self._thread_lock:
+            self._live_procs.add(process)
 
-      with self._thread_lock:
-        self._items_done = self._items_done + 1
+            if self._failed:
+              self._signal_process(process)
 
-        if self._dryrun is False:
-          self._processes.remove(process)
+          #drain stderr on its own thread so neither pipe can fill and stall the command
+          error_thread = threading.Thread(target=self._drain_pipe, name="stderr", args=[process.stderr, cmd_error])
+          error_thread.start()
 
-        time.sleep(1)
+          #stream stdout to the log as it is produced instead of buffering all of it
+          for line in process.stdout:
+            logger.debug(line.rstrip('\n'))
 
-        logger.info(f"Completed command: {' '.join(command)}")
+          error_thread.join()
 
-  def _project_cmd_count(self, run_types):
-    count = 0
+          exception = process.wait()
+          if exception:
+            for line in cmd_error:
+              if len(line.rstrip('\n')):
+                logger.error(line.rstrip('\n'))
+            raise Exception(f"Issue executing command: {cmd_str}")
+        except Exception as e: raise
+        finally:
+          if process is not None:
+            #still running means we got here by an exception such as KeyboardInterrupt, don't orphan it
+            if process.poll() is None:
+              self._signal_process(process)
 
-    for run_type, commands in run_types.items():
-      for command_list in commands:
-        count = count + (len(command_list))
+            with self._thread_lock:
+              self._live_procs.discard(process)
 
-    return count
+      self._done_q.put_nowait(1)
 
-  def _thread_exception(self, args):
-    self._failed = True
+      if logger.isEnabledFor(logging.INFO):
+        logger.info(f"Completed command: {cmd_str}")
 
-    if self._dryrun is False:
-      for p in self._processes:
-        p.terminate()
+  # read a pipe into lines until it closes. Errors are logged and the rest of the pipe is
+  # discarded, this must not stop reading early or the command can block on a full pipe.
+  def _drain_pipe(self, stream, lines):
+    try:
+      for line in stream:
+        lines.append(line)
+    except Exception as e:
+      logger.error(f"Error reading command output, discarding the rest: {str(e)}")
+
+      try:
+        while stream.buffer.read(65536):
+          pass
+      except Exception as e:
+        logger.error(f"Error discarding command output: {str(e)}")
+
+  # drain completion events posted by the builder threads, only the bar thread calls this.
+  def _items_done_count(self):
+    delta = 0
+
+    while True:
+      try:
+        delta = delta + self._done_q.get_nowait()
+      except queue.Empty:
+        break
+
+    self._items_done = self._items_done + delta
 
-    logger.error(f"Build failed, terminated subprocess and program. {str(args.exc_value)}")
+    return self._items_done
 
   def _bar_thread(self):
     status = "BUILDING"
@@ -301,10 +553,23 @@ class bob:
 
     bar.update(Status=f"{status:^8}")
 
-    while((self._items_done < self._items) and (self._failed == False)):
-      time.sleep(0.1)
-      bar.update(Target=f"{self._project_name:<64}")
-      bar.update(self._items_done)
+    items_done = self._items_done_count()
+
+    last_done = None
+    last_name = None
+
+    #redraw at 2 Hz, and only when something has changed
+    while((items_done < self._items) and (self._failed == False)):
+      time.sleep(0.5)
+      items_done = self._items_done_count()
+      project_name = self._project_name
+      if project_name is not last_name:
+        bar.update(items_done, Target=f"{project_name:<64}")
+        last_done = items_done
+        last_name = project_name
+      elif items_done != last_done:
+        bar.update(items_done)
+        last_done = items_done
 
     if self._failed:
       status = "ERROR"
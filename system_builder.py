@@ -36,6 +36,7 @@ import sys
 import argparse
 import logging
 import time
+import signal
 
 logger = logging.getLogger()
 
@@ -75,6 +76,13 @@ def main():
   if args.list_all:
     exit(list_projects(yaml_data, args.config_file))
 
+  if args.ninja_file is not None:
+    try:
+      exit(builder.bob("py/build_cmds.yml", yaml_data, args.target).ninja(args.ninja_file))
+    except Exception as e:
+      print("ERROR: " + str(e))
+      exit(~0)
+
   if args.nodepcheck is False:
     try:
       deps_check(args.deps_file)
@@ -90,12 +98,16 @@ def main():
 
   bob = builder.bob("py/build_cmds.yml", yaml_data, args.target, args.dryrun)
 
+  # build commands run in their own sessions, so treat a hangup or terminate like CTRL+C to stop them too.
+  signal.signal(signal.SIGTERM, signal_interrupt)
+  signal.signal(signal.SIGHUP, signal_interrupt)
+
   try:
     bob.run()
   except KeyboardInterrupt:
     bob.stop()
     time.sleep(1)
-    print("\n" + f"Build interrupted with CTRL+C.")
+    print("\n" + f"Build interrupted with CTRL+C or a stop signal.")
     exit(~0)
   except Exception as e:
     logger.error(str(e))
@@ -107,6 +119,10 @@ def main():
 
   exit(0)
 
+# raise the same exception as CTRL+C so the build is stopped the same way
+def signal_interrupt(signum, frame):
+  raise KeyboardInterrupt
+
 def list_deps(deps_file):
   try:
     deps = open(deps_file, 'r')
@@ -166,25 +182,20 @@ def submodule_init(repo):
     # if len(submodule.children()):
     #   submodule_init(submodule)
 
-# open the yaml file for processing
+# open the yaml file for processing, parse results are cached between runs
 def open_yaml(file_name):
   try:
-    stream = open(file_name, 'r')
-  except:
+    yaml_data = builder.load_yaml_cached(file_name)
+  except OSError:
     print(file_name + " not available.")
     return None
-
-  try:
-    yaml_data = yaml.safe_load(stream)
   except yaml.YAMLError as e:
     logger.error("yaml issue")
     for line in str(e).split("\n"):
       logger.error(line)
     print("ERROR: check log for yaml parse error.")
-    stream.close()
     return None
 
-  stream.close()
   return yaml_data
 
 # List projects from the yaml file.
@@ -239,6 +250,7 @@ def parse_args(argv):
   parser.add_argument('--debug',      action='store_true',  default=False,        dest='debug',       required=False, help='Turn on debug logging messages')
   parser.add_argument('--dryrun',     action='store_true',  default=False,        dest='dryrun',      required=False, help='Run build without executing commands.')
   parser.add_argument('--noupdate',   action='store_true',  default=False,        dest='noupdate',    required=False, help='Run build without updating submodules.')
+  parser.add_argument('--ninja',      action='store',       default=None,         dest='ninja_file',  required=False, help='Write a ninja build file for the targets instead of building them. Run ninja -f NINJA_FILE from the repository root.')
   parser.add_argument('--nodepcheck', action='store_true',  default=False,        dest='nodepcheck',  required=False, help='Run build without checking dependencies.')
 
   return parser.parse_args()